@@ -1,55 +1,147 @@
-import torch
 import os
-import gymnasium as gym
-import numpy as np
+
+# Must be set before torch initializes CUDA: expandable segments let the
+# caching allocator grow one VA-backed pool instead of fragmenting across
+# cudaMalloc'd blocks as PPO's variable-sized activation tensors come and go.
+os.environ.setdefault(
+    "PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512"
+)
+
+import torch
 import logging
+import logging.handlers
 import json
-import shutil
+import atexit
 from datetime import datetime
 from pprint import pprint
 
+# Observation and minibatch shapes are fixed for the whole run, so let
+# cuDNN autotune its conv algorithm once and cache the winner.
+torch.backends.cudnn.benchmark = True
+torch.backends.cudnn.allow_tf32 = True
+# Allow TF32 for the fp32 matmuls that remain outside the bf16 autocast
+# region (optimizer-side math, value targets).
+torch.set_float32_matmul_precision("high")
+
 # ==============================
-#  Atari → Float32 Wrapper
+#  Environment
 # ==============================
-class FloatObsEnv(gym.Env):
-    def __init__(self, config=None):
-        self.env = gym.make("ale_py:ALE/Pacman-v5")
-        original_space = self.env.observation_space
-        self.observation_space = gym.spaces.Box(
-            low=original_space.low.astype(np.float32) / 255.0,
-            high=original_space.high.astype(np.float32) / 255.0,
-            shape=original_space.shape,
-            dtype=np.float32,
-        )
-        self.action_space = self.env.action_space
+# The env lives in its own torch-free module so env-runner workers that only
+# build environments don't pay the torch import (~1s / ~300MB RSS each).
+# Importing it registers "Pacman" with Ray's env registry.
+import pacman_env  # noqa: F401
+
+# ==============================
+#  RLModule (on-device normalization)
+# ==============================
+from ray.rllib.algorithms.ppo.torch.default_ppo_torch_rl_module import DefaultPPOTorchRLModule
+from ray.rllib.core.columns import Columns
+
+# Multiply by the reciprocal instead of dividing by 255 in the hot path.
+INV_255 = 1.0 / 255.0
+
+class PacmanPPOTorchRLModule(DefaultPPOTorchRLModule):
+    """Default PPO torch module, but normalizing raw uint8 frames itself.
 
-    def reset(self, seed=None, options=None):
-        obs, info = self.env.reset(seed=seed, options=options)
-        return obs.astype(np.float32) / 255.0, info
+    The env emits uint8 frames; casting to float32 and dividing by 255 only
+    happens here, after the batch has already been moved to the GPU.
+    """
 
-    def step(self, action):
-        obs, reward, terminated, truncated, info = self.env.step(action)
-        return obs.astype(np.float32) / 255.0, reward, terminated, truncated, info
+    def _normalize_obs(self, batch):
+        obs = batch[Columns.OBS]
+        if obs.dtype == torch.uint8:
+            # Cast before scaling — scaling in uint8 would truncate to zero.
+            batch[Columns.OBS] = obs.to(torch.float32).mul_(INV_255)
+        return batch
+
+    def compute_values(self, batch, embeddings=None):
+        # PPO's GAE learner connector calls this directly with the raw uint8
+        # batch (it never goes through _forward_train), so the value path
+        # needs the same normalization or the critic sees 0-255 inputs.
+        return super().compute_values(self._normalize_obs(batch), embeddings=embeddings)
+
+    def _forward_inference(self, batch, **kwargs):
+        return super()._forward_inference(self._normalize_obs(batch), **kwargs)
+
+    def _forward_exploration(self, batch, **kwargs):
+        return super()._forward_exploration(self._normalize_obs(batch), **kwargs)
+
+    def _forward_train(self, batch, **kwargs):
+        batch = self._normalize_obs(batch)
+        if not torch.cuda.is_available():
+            return super()._forward_train(batch, **kwargs)
+        # bf16 halves activation/gradient bytes and runs on the tensor cores;
+        # its fp32-sized exponent range needs no GradScaler. Outputs are cast
+        # back so the PPO loss and the optimizer step stay in fp32.
+        with torch.autocast(device_type="cuda", dtype=torch.bfloat16):
+            out = super()._forward_train(batch, **kwargs)
+        return {
+            k: v.float() if torch.is_tensor(v) and v.is_floating_point() else v
+            for k, v in out.items()
+        }
 
 # ==============================
-#  Register environment
+#  Learner (pinned-memory copies)
 # ==============================
-from ray.tune.registry import register_env
-def env_creator(config):
-    return FloatObsEnv(config)
-register_env("PacmanFloat", env_creator)
+from ray.rllib.algorithms.ppo.torch.ppo_torch_learner import PPOTorchLearner
+from ray.rllib.connectors.common import NumpyToTensor
+
+class PacmanPPOTorchLearner(PPOTorchLearner):
+    """PPO torch learner whose batch conversion pins host memory.
+
+    Train batches reach the GPU through the learner connector pipeline,
+    whose terminal NumpyToTensor piece does the numpy-to-tensor and device
+    move. The stock piece copies from pageable memory, which blocks the
+    CUDA stream; swapping in one with pin_memory=True makes the
+    host-to-device copies DMA transfers that can overlap compute.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if torch.cuda.is_available():
+            # Hard-cap the learner's share of device memory at 90% so a
+            # leak or shape regression OOMs early instead of starving
+            # whatever else shares the GPU. (Allocator growth behavior is
+            # governed by PYTORCH_CUDA_ALLOC_CONF at the top of the file.)
+            torch.cuda.set_per_process_memory_fraction(0.9)
+
+    def build(self):
+        super().build()
+        if self._device.type != "cuda":
+            return
+        for idx, piece in enumerate(self._learner_connector.connectors):
+            if isinstance(piece, NumpyToTensor):
+                self._learner_connector.connectors[idx] = NumpyToTensor(
+                    as_learner_connector=True,
+                    pin_memory=True,
+                    device=self._device,
+                )
 
 # ==============================
 #  RLlib PPO Config
 # ==============================
 from ray.rllib.algorithms.ppo import PPOConfig
 from ray.rllib.core.rl_module.default_model_config import DefaultModelConfig
+from ray.rllib.core.rl_module.rl_module import RLModuleSpec
 
 config = (
     PPOConfig()
-    .environment("PacmanFloat")
-    .env_runners(num_env_runners=60, num_envs_per_env_runner=2)
+    .environment("Pacman")
+    # Compile the whole train forward on the learner: reduce-overhead wraps
+    # the shape-stable forward+backward in CUDA graphs, collapsing the ~15
+    # short eager kernel launches per minibatch into graph replays. Shapes
+    # are stable because train_batch_size and minibatch_size are fixed.
+    .framework(
+        "torch",
+        torch_compile_learner=True,
+        torch_compile_learner_dynamo_mode="reduce-overhead",
+    )
+    # Fewer actors, more envs per actor: each runner batches its policy
+    # forward over 8 envs at once instead of paying Ray actor/IPC overhead
+    # per pair of envs. 16x8 = 128 envs total, up from 126 on 1/4 the actors.
+    .env_runners(num_env_runners=16, num_envs_per_env_runner=8)
     .rl_module(
+        rl_module_spec=RLModuleSpec(module_class=PacmanPPOTorchRLModule),
         model_config=DefaultModelConfig(
             conv_activation="relu",
             conv_filters=[
@@ -62,13 +154,17 @@ config = (
         )
     )
     .training(
+        learner_class=PacmanPPOTorchLearner,
         lr=0.0002,
         train_batch_size=8000,
         num_epochs=10,
     )
     .evaluation(
         evaluation_interval=5,
-        evaluation_num_env_runners=4
+        evaluation_num_env_runners=1,
+        evaluation_parallel_to_training=True,
+        evaluation_duration=10,
+        evaluation_duration_unit="episodes",
     )
 )
 
@@ -109,34 +205,54 @@ formatter = logging.Formatter("%(asctime)s %(levelname)s: %(message)s")
 fh = logging.FileHandler(os.path.join(save_dir, "train.log"))
 fh.setLevel(logging.INFO)
 fh.setFormatter(formatter)
+# Buffer file writes so the training loop doesn't flush to disk on every
+# logger.info. Capacity stays small: at ~3 records per iteration this still
+# batches a few iterations per flush, while keeping train.log fresh enough
+# to tail during a run and bounding what a walltime SIGKILL (which skips
+# atexit) can lose. Errors flush immediately.
+mh = logging.handlers.MemoryHandler(capacity=16, flushLevel=logging.ERROR, target=fh)
+atexit.register(mh.close)
 sh = logging.StreamHandler()
 sh.setLevel(logging.INFO)
 sh.setFormatter(formatter)
 if not logger.handlers:
-    logger.addHandler(fh)
+    logger.addHandler(mh)
     logger.addHandler(sh)
 
+def scalar(value):
+    # Metrics coming out of the result dict can still be 0-dim torch tensors;
+    # holding those across iterations keeps their storage (and any autograd
+    # graph) alive, so unwrap to a plain Python number before logging.
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
 for i in range(100):
     result = algo.train()
     logger.info("=== Training iteration %d ===", i)
-    # Summary of important metrics
-    episode_return_mean = result.get('env_runners', {}).get('episode_return_mean', 'N/A')
-    episode_len_mean = result.get('env_runners', {}).get('episode_len_mean', 'N/A')
-    num_episodes = result.get('env_runners', {}).get('num_episodes', 'N/A')
-    num_env_steps_sampled_lifetime = result.get('env_runners', {}).get('num_env_steps_sampled_lifetime', 'N/A')
-    time_this_iter_s = result.get('time_this_iter_s', 'N/A')
-    total_loss = result.get('learners', {}).get('default_policy', {}).get('total_loss', 'N/A')
-    vf_loss = result.get('learners', {}).get('default_policy', {}).get('vf_loss', 'N/A')
-    policy_loss = result.get('learners', {}).get('default_policy', {}).get('policy_loss', 'N/A')
-    entropy = result.get('learners', {}).get('default_policy', {}).get('entropy', 'N/A')
+    # Summary of important metrics. Resolve the nested sections once instead
+    # of allocating a fresh default dict per .get(...).get(...) lookup.
+    env_runner_results = result.get('env_runners') or {}
+    learner_results = (result.get('learners') or {}).get('default_policy') or {}
+    episode_return_mean = scalar(env_runner_results.get('episode_return_mean', 'N/A'))
+    episode_len_mean = scalar(env_runner_results.get('episode_len_mean', 'N/A'))
+    num_episodes = scalar(env_runner_results.get('num_episodes', 'N/A'))
+    num_env_steps_sampled_lifetime = scalar(env_runner_results.get('num_env_steps_sampled_lifetime', 'N/A'))
+    time_this_iter_s = scalar(result.get('time_this_iter_s', 'N/A'))
+    total_loss = scalar(learner_results.get('total_loss', 'N/A'))
+    vf_loss = scalar(learner_results.get('vf_loss', 'N/A'))
+    policy_loss = scalar(learner_results.get('policy_loss', 'N/A'))
+    entropy = scalar(learner_results.get('entropy', 'N/A'))
     
     logger.info("Summary - Episode Return Mean: %s, Episode Len Mean: %s, Num Episodes: %s, Total Steps: %s, Time: %.2f s",
                 episode_return_mean, episode_len_mean, num_episodes, num_env_steps_sampled_lifetime, time_this_iter_s)
     logger.info("Losses - Total: %s, VF: %s, Policy: %s, Entropy: %s",
                 total_loss, vf_loss, policy_loss, entropy)
-    
-    # Uncomment the line below to log the full result dict if needed
-    logger.info(result)
+
+    # Full result dump is expensive (megabytes of nested metrics per iter);
+    # only emit it occasionally and only when DEBUG logging is enabled.
+    if i % 10 == 0 and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(json.dumps(result, default=str))
 
 # ==============================
 #  Evaluation
@@ -0,0 +1,110 @@
+import os
+
+import gymnasium as gym
+import numpy as np
+
+# This module is deliberately torch-free: it is what Ray imports into the
+# env-runner worker processes to build environments, and pulling torch in
+# there costs ~1s of import time and hundreds of MB of RSS per worker.
+# Anything model-related lives in main.py.
+
+try:
+    import envpool
+except ImportError:
+    envpool = None
+
+# ==============================
+#  Atari uint8 env
+# ==============================
+# Observations stay uint8 all the way from ALE to the GPU: serializing raw
+# frames through Ray costs 4x fewer bytes than float32, and the /255
+# normalization happens on-device in the RLModule. Standard Atari
+# preprocessing (grayscale, 84x84, 4-frame stack) shrinks each observation
+# from ~100KB of RGB pixels to ~28KB, matching what EnvPool emits. The
+# wrappers are returned directly — no proxy gym.Env subclass adding an
+# extra Python frame to every step.
+# RLlib's default CNN encoder expects channels-last (H, W, C) images and
+# permutes to NCHW internally; the frame stack therefore has to sit in the
+# last dimension, not the first.
+OBS_SPACE = gym.spaces.Box(low=0, high=255, shape=(84, 84, 4), dtype=np.uint8)
+
+def _stack_last(obs):
+    return np.transpose(obs, (1, 2, 0))
+
+def make_pacman_env():
+    # AtariPreprocessing applies its own frame skip, so the base env
+    # must run with frameskip=1 (the v5 default is 4).
+    env = gym.make("ale_py:ALE/Pacman-v5", frameskip=1)
+    env = gym.wrappers.AtariPreprocessing(
+        env,
+        grayscale_obs=True,
+        screen_size=84,
+        frame_skip=4,
+        scale_obs=False,
+    )
+    # FrameStackObservation emits (4, 84, 84); move the stack to the back.
+    env = gym.wrappers.FrameStackObservation(env, stack_size=4)
+    return gym.wrappers.TransformObservation(env, _stack_last, OBS_SPACE)
+
+# ==============================
+#  EnvPool backend
+# ==============================
+# EnvPool runs the ALE core (plus the standard grayscale/resize/frame-stack
+# preprocessing) in C++, skipping the Python-level step overhead of the
+# plain gymnasium env. This adapter drives a single sub-env under RLlib's
+# own num_envs_per_env_runner vectorization, so EnvPool's batched C++
+# stepping is not exploited — which is why the backend is opt-in rather
+# than the default (see env_creator) until a vector-env integration lands.
+class EnvPoolPacmanEnv(gym.Env):
+    def __init__(self, config=None):
+        self.env = self._make()
+        # EnvPool also stacks channel-first; transpose to (84, 84, 4) like
+        # the gymnasium path so both backends feed the CNN the same layout.
+        self.observation_space = OBS_SPACE
+        self.action_space = self.env.action_space
+
+    @staticmethod
+    def _make(seed=None):
+        kwargs = dict(
+            num_envs=1,
+            stack_num=4,
+            # Match ALE v5 dynamics: EnvPool defaults to no sticky actions,
+            # which would make the two backends different MDPs.
+            repeat_action_probability=0.25,
+        )
+        if seed is not None:
+            kwargs["seed"] = seed
+        return envpool.make_gymnasium("Pacman-v5", **kwargs)
+
+    def reset(self, seed=None, options=None):
+        if seed is not None:
+            # EnvPool only accepts a seed at construction time.
+            self.env = self._make(seed)
+        obs, info = self.env.reset()
+        return _stack_last(obs[0]), info
+
+    def step(self, action):
+        obs, reward, terminated, truncated, info = self.env.step(
+            np.array([action])
+        )
+        return _stack_last(obs[0]), reward[0], terminated[0], truncated[0], info
+
+# ==============================
+#  Register environment
+# ==============================
+from ray.tune.registry import register_env
+def env_creator(config):
+    # The backend is an explicit choice (env_config or PACMAN_ENV_BACKEND),
+    # not an import probe: silently switching on envpool availability would
+    # make runs from different installs incomparable.
+    backend = (config or {}).get(
+        "backend", os.environ.get("PACMAN_ENV_BACKEND", "ale")
+    )
+    if backend == "envpool":
+        if envpool is None:
+            raise RuntimeError(
+                "backend='envpool' was requested but envpool is not installed"
+            )
+        return EnvPoolPacmanEnv(config)
+    return make_pacman_env()
+register_env("Pacman", env_creator)